@@ -11,6 +11,9 @@ from .. import common as sfcom
 from firedrake import *
 
 class IceFabric:
+
+    L2_CACHE_SIZE = 256*1024 # bytes; nodal dynamical matrices are assembled in tiles of DOFs whose matrix rows fit in L2 cache
+
     def __init__(
         self, mesh, boundaries, L, nu_multiplier=1, nu_realspace=1e-3, modelplane='xz', symframe=-1, ds=None, nvec=None
     ):
@@ -45,9 +48,14 @@ class IceFabric:
         self.G = TensorFunctionSpace(self.mesh, eletype, eleorder, shape=(2,2))
         # Get vector() size w/ MPI (else self.R.dim())
         self.numdofs = Function(self.R).vector().local_size()
+        # Number of DOFs per tile when assembling nodal dynamical matrices: one matrix row Mrr[ii] of the tile is written at a time, 
+        # so a row of the tile + nodal D, W (i.e. nlm_len + 4+4 doubles per DOF) should fit in L2 (whole matrices would make tiles too small 
+        # to amortize the per-row writes for large L).
+        self.numdofs_tile = max(1, self.L2_CACHE_SIZE//(8*(self.nlm_len + 8)))
 
         ### Viscous anisotropy
         self.R0 = FunctionSpace(self.mesh, "DG", 0)
+        self.V0 = VectorFunctionSpace(self.mesh, "DG", 0, dim=self.nlm_len)
         self.G0 = TensorFunctionSpace(self.mesh, "DG", 0, shape=(2,2))
         self.numdofs0 = Function(self.R0).vector().local_size()
 
@@ -71,6 +79,8 @@ class IceFabric:
         self.nlm_iso   = [1/np.sqrt(4*np.pi)] + [0]*(self.nlm_len-1) # Isotropic and normalized state
         self.nlm_zero  = [0]*(self.nlm_len)
         self.nlm_dummy = np.zeros((self.nlm_len_full))
+        # rnlm_to_nlm() is linear for real-valued reduced states (xz model plane), so it can be applied to all nodes at once as a matrix
+        self.rnlm_to_nlm_mat = np.array([self.sf.rnlm_to_nlm(e+0j, self.nlm_len_full) for e in np.eye(self.nlm_len)]).T
         
     def initialize(self, wr=None, wi=None):
         """
@@ -111,19 +121,17 @@ class IceFabric:
         Wf = project(skew(grad(u)), self.G).vector()[:] # spin
         Sf = project(S, self.G).vector()[:] # deviatoric stress
 
-        # Dynamical matrices at each DOF (note indexing is different from FEniCS)
+        # Dynamical matrices at each DOF (note indexing is different from FEniCS), populated tile by tile of DOFs.
+        # Tiles are laid out as M[ii,dof,jj], i.e. a contiguous (dof,jj) block per row ii just like Mrr[ii].vector()
+        kk = 0 # real-real interactions only
         if ENABLE_LROT:
-            M_LROT_nodal = np.array([self.sf.reduce_M(self.sf.M_LROT(self.nlm_dummy, self.mat3d(Df[nn]), self.mat3d(Wf[nn]), iota, zeta), self.nlm_len) for nn in np.arange(self.numdofs)] )
+            if zeta == 0: M_LROT_nodal = self.Mrr_LROT_nodal(Df, Wf, iota) # batched over DOFs
+            else:         M_LROT_nodal = ((dofs, np.stack([self.sf.reduce_M(self.sf.M_LROT(self.nlm_dummy, self.mat3d(Df[nn]), self.mat3d(Wf[nn]), iota, zeta), self.nlm_len)[kk] for nn in np.arange(self.numdofs)[dofs]], axis=1)) for dofs in self.dof_tiles())
+            self.set_nodal(self.Mrr_LROT, M_LROT_nodal)
         if ENABLE_DDRX: 
-            M_DDRX_src_nodal = np.array([self.sf.reduce_M(self.sf.M_DDRX_src(self.nlm_dummy, self.mat3d(Sf[nn])), self.nlm_len) for nn in np.arange(self.numdofs)] )
-        M_REG_nodal = np.array([self.sf.reduce_M(self.sf.M_REG(self.nlm_dummy, self.mat3d(Df[nn])), self.nlm_len) for nn in np.arange(self.numdofs)] )
-
-        # Populate entries of dynamical matrices
-        kk = 0 # real-real interactions only
-        for ii in np.arange(self.nlm_len):
-            if ENABLE_LROT: self.Mrr_LROT[ii].vector()[:] = M_LROT_nodal[:,kk,ii,:]
-            if ENABLE_DDRX: self.Mrr_DDRX_src[ii].vector()[:] = M_DDRX_src_nodal[:,kk,ii,:]
-            self.Mrr_REG[ii].vector()[:] = M_REG_nodal[:,kk,ii,:]
+            M_DDRX_src_nodal = ((dofs, np.stack([self.sf.reduce_M(self.sf.M_DDRX_src(self.nlm_dummy, self.mat3d(Sf[nn])), self.nlm_len)[kk] for nn in np.arange(self.numdofs)[dofs]], axis=1)) for dofs in self.dof_tiles())
+            self.set_nodal(self.Mrr_DDRX_src, M_DDRX_src_nodal)
+        self.set_nodal(self.Mrr_REG, self.Mrr_REG_nodal(Df)) # batched over DOFs
 
         ### Construct weak form
 
@@ -155,6 +163,55 @@ class IceFabric:
 
         return F
 
+    def dof_tiles(self):
+        """
+        DOF slices used for assembling nodal dynamical matrices
+        """
+        return [slice(nn, min(nn+self.numdofs_tile, self.numdofs)) for nn in range(0, self.numdofs, self.numdofs_tile)]
+
+    def set_nodal(self, Mrr, Mrr_nodal):
+        """
+        Populate entries of dynamical matrix Mrr given (dofs, nodal matrices) tiles, each nodal matrix tile being indexed as M[ii,dof,jj]
+        """
+        for dofs, M in Mrr_nodal:
+            for ii in np.arange(self.nlm_len): 
+                Mrr[ii].vector()[dofs] = M[ii]
+
+    def Mrr_LROT_nodal(self, Df, Wf, iota):
+        """
+        Reduced (real-real) lattice rotation matrix at each DOF for zeta=0, yields (dofs, nodal matrices) tiles
+        """
+        # M_LROT is linear in (D,W) for zeta=0, so instead of calling the fortran routine per DOF, the nodal components 
+        # of D and W are contracted against a basis of matrices, i.e. a (numdofs,8)x(8,nlm_len) GEMM per row of the
+        # matrices (done per tile, reusing a cache-sized output buffer).
+        # The basis is evaluated around D=I since the zeta normalization is undefined for D=0.
+        I = np.eye(3)
+        Mrr = lambda D, W: self.sf.reduce_M(self.sf.M_LROT(self.nlm_dummy, D, W, iota, 0), self.nlm_len)[0]
+        M0 = Mrr(I, 0*I)
+        E = np.eye(4).reshape((4,2,2)) # basis for 2x2 tensors
+        basis = np.array([Mrr(I+self.mat3d(Ek), 0*I)-M0 for Ek in E] + [Mrr(I, self.mat3d(Ek))-M0 for Ek in E])
+        basis = np.ascontiguousarray(basis.transpose((1,0,2))) # basis[ii,:,jj] 
+        DW = np.hstack((np.reshape(Df, (-1,4)), np.reshape(Wf, (-1,4))))
+        M = np.empty(self.numdofs_tile*self.nlm_len**2)
+        for dofs in self.dof_tiles():
+            M_ = M[:(dofs.stop-dofs.start)*self.nlm_len**2].reshape((self.nlm_len,-1,self.nlm_len))
+            np.matmul(DW[dofs], basis, out=M_)
+            yield dofs, M_
+
+    def Mrr_REG_nodal(self, Df):
+        """
+        Reduced (real-real) regularization matrix at each DOF, yields (dofs, nodal matrices) tiles
+        """
+        # M_REG depends on D only through its magnitude, M_REG(D) = ||D||*M_REG(D/||D||)
+        D = np.reshape(Df, (-1,4))
+        Dnorm = np.sqrt(np.sum(D**2, axis=1) + (D[:,0]+D[:,3])**2) # ||mat3d(D)||
+        M1 = self.sf.reduce_M(self.sf.M_REG(self.nlm_dummy, np.eye(3)/np.sqrt(3)), self.nlm_len)[0]
+        M = np.empty(self.numdofs_tile*self.nlm_len**2)
+        for dofs in self.dof_tiles():
+            M_ = M[:(dofs.stop-dofs.start)*self.nlm_len**2].reshape((self.nlm_len,-1,self.nlm_len))
+            np.multiply(Dnorm[None,dofs,None], M1[:,None,:], out=M_)
+            yield dofs, M_
+
     def evolve(self, u, S, dt, iota=+1, Gamma0=None, Lambda0=None, steadystate=False):
         """
         Evolve CPO using Laplacian stabilized, Euler time integration
@@ -194,8 +251,8 @@ class IceFabric:
         """
         state vector nlm per node as np array
         """
-        rnlm = np.array([ project(self.w[ii],self.R0).vector()[:] + 0j for ii in range(self.nlm_len) ]) # reduced form per node
-        nlm = np.array([ self.sf.rnlm_to_nlm(rnlm[:,nn], self.nlm_len_full) for nn in range(self.numdofs0) ]) # *full* form
+        rnlm = np.reshape(project(self.w, self.V0).vector()[:], (-1,self.nlm_len)) # reduced form per node, all components projected at once
+        nlm = np.einsum('ij,nj->ni', self.rnlm_to_nlm_mat, rnlm) # *full* form, converted for all nodes at once
         return nlm # nlm[node,coef]
  
     def E_CAFFE(self, u, Emin=0.1, Emax=10):
@@ -1,16 +1,54 @@
 # N. M. Rathmann <rathmann@nbi.ku.dk>, 2023
 
+import os, functools, warnings
+import multiprocessing
 import numpy as np
-from progress.bar import Bar
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from scipy.linalg import expm
+from scipy.linalg.blas import zgemv, zaxpy
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import expm_multiply
+
+from .specfabpy import specfabpy as sf__ # sf private copy (for worker processes)
+
+try:
+    from numba import njit
+except ImportError: 
+    njit = None # numba is optional, fall back to numpy time stepping if not available
+    
+# Time-constant operators with a smaller fraction of nonzero entries than these are applied in sparse (CSR) form.
+# Without numba, scipy's per-call overhead of sparse products only pays off for fairly sparse operators (large L).
+SPARSE_DENSITY       = 0.25 # numba kernel
+SPARSE_DENSITY_SCIPY = 0.10 # scipy.sparse fallback
+
+# method='rk4' without DDRX: scipy's expm_multiply (truncated Taylor series, Al-Mohy and Higham, 2011) costs sparse matvecs per time step 
+# whereas a dense expm() costs O(nlm_len^3) once, so the former is used for Nt < EXPM_MULTIPLY_MAXSTEPS_PER_NLM2*nlm_len^2 (break-even measured for L=12-30)
+EXPM_MULTIPLY_MAXSTEPS_PER_NLM2 = 1e-3
 
 def lagrangianparcel(sf, mod, strain_target, Nt=100, dt=None, nlm0=None, verbose=True, \
                     iota=None, zeta=0, Lambda=None, Gamma0=None, # fabric process params \
-                    nu=None, regexpo=None, apply_bounds=False # regularization \
+                    nu=None, regexpo=None, apply_bounds=False, # regularization \
+                    method='euler', nprocs=None, # time integration scheme: 'euler', 'rk4', or 'parareal' (with nprocs processes) \
     ):
 
     """
     Lagrangian parcel integrator subject to a time-constant mode of deformation (constant ugrad)
+    
+    method='euler' is the explicit Euler scheme that the regularization is calibrated for.
+    method='rk4' uses the exact propagator expm(dt*M) if the CPO operator M is time constant (no DDRX), 
+    and classical fourth-order Runge--Kutta otherwise, allowing for much larger time steps (smaller Nt).
+    method='parareal' converges to the 'euler' solution, but integrates time subintervals in parallel (nprocs processes, default all CPUs). 
+    Only worthwhile for costly integrations (DDRX, large Nt) since worker processes must be started on each call.
+    Worker processes are forked where possible (Linux, macOS); on platforms without fork (Windows) the calling script 
+    must be guarded by if __name__ == '__main__', else the integration falls back to serial 'euler'.
     """
+    
+    if method not in ('euler', 'rk4', 'parareal'):
+        raise ValueError('Integration method="%s" not supported'%(method))
+        
+    if nprocs is not None and nprocs < 1:
+        raise ValueError('nprocs=%s must be a positive number of processes'%(nprocs))
 
     ### Mode of deformation
     
@@ -19,13 +57,13 @@ def lagrangianparcel(sf, mod, strain_target, Nt=100, dt=None, nlm0=None, verbose
     if mod['type'] == 'simpleshear' or mod['type'] == 'ss':
         # strain_target is shear angle (rad)
         if dt is None: dt = sf.simpleshear_gamma_to_t(strain_target, mod['T'])/Nt
-        F     = np.array([sf.simpleshear_F(mod['plane'], mod['T'], dt*nt) for nt in np.arange(Nt+1)])
+        time, F = _trajectory('ss', mod['plane'], None, mod['T'], dt, Nt)
         ugrad = sf.simpleshear_ugrad(mod['plane'], mod['T'])
         
     elif mod['type'] == 'pureshear' or mod['type'] == 'ps':
         # strain_target is axial strain
         if dt is None: dt = sf.pureshear_strainii_to_t(strain_target, mod['T'])/Nt
-        F     = np.array([sf.pureshear_F(mod['axis'], mod['r'], mod['T'], dt*nt) for nt in np.arange(Nt+1)])
+        time, F = _trajectory('ps', mod['axis'], mod['r'], mod['T'], dt, Nt)
         ugrad = sf.pureshear_ugrad(mod['axis'], mod['r'], mod['T'])
         
     elif mod['type'] == 'rigidrotation' or mod['type'] == 'rr':
@@ -37,50 +75,307 @@ def lagrangianparcel(sf, mod, strain_target, Nt=100, dt=None, nlm0=None, verbose
     
     D, W = sf.ugrad_to_D_and_W(ugrad) 
     S = D.copy() # assume coaxial stress strain-rate
-    time = dt*np.arange(Nt+1)    
 
     ### State vector
 
     nlm_len = sf.nlm_len()
-    nlm  = np.zeros((Nt+1,nlm_len), dtype=np.complex64)
+    nlm  = np.zeros((Nt+1,nlm_len), dtype=np.complex128, order='C') # same precision as the fortran operators, avoids conversions when passing to/from BLAS or specfab; row-major so that each state nlm[nt,:] is contiguous
     if nlm0 is None: nlm[0,0] = 1/np.sqrt(4*np.pi) # initially isotropic distribution
     else:            nlm[0,:] = nlm0 # initial state provided by caller
-    nlm_dummy = nlm[0,:].copy()
     
-    ### Steady CPO operators
-
-    M_zero = np.zeros((nlm_len,nlm_len), dtype=np.complex64)
+    ### Steady CPO operators (None if disabled)
+    
+    nlm_ = nlm[0,:] # operators below depend only on the size of the state vector, so pass a view rather than a copy 
 
     # Regularization
-    if regexpo is None: M_REG = nu*sf.M_REG(nlm_dummy, D) if nu is not None else M_zero
+    if regexpo is None: M_REG = nu*sf.M_REG(nlm_, D) if nu is not None else None
     else:               M_REG = M_REG_custom(nu, regexpo, D, sf)
     
     # CDRX
-    M_CDRX = Lambda*sf.M_CDRX(nlm_dummy) if Lambda is not None else M_zero
+    M_CDRX = Lambda*sf.M_CDRX(nlm_) if Lambda is not None else None
 
     # Lattice rotation
-    M_LROT = sf.M_LROT(nlm_dummy, D, W, iota, zeta) if iota is not None else M_zero
+    M_LROT = sf.M_LROT(nlm_, D, W, iota, zeta) if iota is not None else None
            
     ### Process rate factors 
     
     Gamma0_ = Gamma0(ugrad=ugrad) if callable(Gamma0) else Gamma0
 
            
-    ### Euler integration
+    ### Time integration
+
+    if verbose:
+        from progress.bar import Bar # only needed (and imported) when verbose
+        bar = Bar('MOD=%s :: Nt=%i :: dt=%.2e :: nlm_len=%i ::'%(mod['type'],Nt,dt,nlm_len), max=Nt, fill='#', suffix='%(percent).1f%% - %(eta)ds')
+    else:
+        bar = None
+    
+    # Time-invariant part of operator, set up once
+    M_static = np.zeros((nlm_len,nlm_len), dtype=np.complex128, order='F') # column-major like the fortran operators and as expected by BLAS (no layout conversions)
+    for M in (M_LROT, M_CDRX, M_REG):
+        if M is not None: M_static += M
+    
+    if   method == 'euler':    _integrate_euler(sf, nlm, M_static, Gamma0_, S, dt, bar=bar)
+    elif method == 'rk4':      _integrate_rk4(sf, nlm, M_static, Gamma0_, S, dt, bar=bar)
+    elif method == 'parareal': _integrate_parareal(sf, nlm, M_static, Gamma0_, S, dt, nprocs=nprocs, bar=bar)
+            
+    if bar is not None: bar.finish()
+            
+    return nlm, F, time, ugrad
+    
+
+def _bar_stride(Nt, nupdates=200):
+    return max(1, Nt//nupdates)
+
+def _bar_update(bar, nt, Nt):
+
+    """
+    Advance progress bar to time step nt, but only every few steps: redrawing the bar can cost as much as a time step for small nlm_len
+    """
+    
+    if bar is not None and (nt % _bar_stride(Nt) == 0 or nt == Nt): bar.goto(nt)
+    
+    
+def _trajectory(modtype, plane_or_axis, r, T, dt, Nt):
+
+    """
+    Times and deformation gradients of parcel trajectory (copies of cached arrays, which are shared between repeated calls, e.g. for many parcels)
+    """
+
+    time, F = _trajectory_cached(modtype, plane_or_axis, r, T, dt, Nt)
+    return time.copy(), F.copy()
+    
+@functools.lru_cache(maxsize=8)
+def _trajectory_cached(modtype, plane_or_axis, r, T, dt, Nt):
+    time = dt*np.arange(Nt+1)
+    if modtype == 'ss': F = _simpleshear_F(plane_or_axis, T, time)
+    else:               F = _pureshear_F(plane_or_axis, r, T, time)
+    return time, F
+    
+    
+def _simpleshear_F(plane, T, time):
+
+    """
+    Deformation gradient of simple shear at each time (vectorized sf.simpleshear_F)
+    """
+    
+    F = np.tile(np.eye(3), (len(time),1,1))
+    ii, jj = ((1,2), (0,2), (0,1))[plane] # y--z, x--z, x--y shear
+    F[:,ii,jj] = time/T # tan(gamma), where gamma = atan(time/T) is the shear angle
+    return F
+    
+    
+def _pureshear_F(axis, r, T, time):
+
+    """
+    Deformation gradient of pure shear at each time (vectorized sf.pureshear_F)
+    """
+    
+    b = np.exp(time/T) # scaling parameter
+    expo = ((-1, (1+r)/2, (1-r)/2), ((1-r)/2, -1, (1+r)/2), ((1+r)/2, (1-r)/2, -1))[axis] # compression along x, y, z
+    F = np.zeros((len(time),3,3))
+    for ii in range(3): F[:,ii,ii] = np.power(b, expo[ii])
+    return F
+    
+    
+def _integrate_euler(sf, nlm, M_static, Gamma0, S, dt, bar=None):
+
+    """
+    Explicit Euler integration of nlm[0,:] (in-place, nlm[1:,:] is overwritten)
+    """
+    
+    Nt = nlm.shape[0]-1
+    
+    if Gamma0 is None:
+        # Time-constant operator, which is sparse in spectral space for all but small L: 
+        # lattice rotation couples only neighbouring (l,m) modes, while regularization and CDRX are diagonal.
+        M_sp = csr_matrix(M_static) # drops structural zeros
+        density = M_sp.nnz/np.prod(M_sp.shape)
+        
+        if njit is not None:
+            sparse = density < SPARSE_DENSITY
+            # Compiled calls over all steps between progress bar updates
+            stride = Nt if bar is None else _bar_stride(Nt)
+            for nt0 in np.arange(1,Nt+1,stride):
+                nt1 = min(nt0+stride, Nt+1)
+                if sparse: _euler_csr(nlm, M_sp.data, M_sp.indices, M_sp.indptr, dt, nt0, nt1)
+                else:      _euler(nlm, M_static, dt, nt0, nt1)
+                _bar_update(bar, nt1-1, Nt)
+            return 
+            
+        if density < SPARSE_DENSITY_SCIPY:
+            for nt in np.arange(1,Nt+1):
+                np.copyto(nlm[nt,:], nlm[nt-1,:])
+                zaxpy(M_sp.dot(nlm[nt-1,:]), nlm[nt,:], a=dt) # in-place y := a*x + y
+                _bar_update(bar, nt, Nt)
+            return
+        
+    # Specialize the time step once, rather than branching on every step
+    
+    if Gamma0 is None:
+        # nlm(t+dt) = P.nlm(t) with P = I + dt*M, in BLAS layout so that zgemv() does not copy P on every call
+        P = np.asfortranarray(np.identity(M_static.shape[0]) + dt*M_static)
+        def step(nt):
+            zgemv(1, P, nlm[nt-1,:], beta=0, y=nlm[nt,:], overwrite_y=True) # in-place, writes directly into row nt
+            
+    elif njit is not None:
+        def step(nt):
+            M = sf.M_DDRX(nlm[nt-1,:], S) # new array on each call, so safe to accumulate in-place
+            M *= Gamma0
+            M += M_static
+            _euler(nlm, M, dt, nt, nt+1)
+            
+    else:
+        def step(nt):
+            nlm_prev = nlm[nt-1,:]
+            M = sf.M_DDRX(nlm_prev, S) 
+            M *= Gamma0
+            M += M_static
+            # nlm_prev + dt*M.nlm_prev in a single in-place BLAS call (y := alpha*M.x + beta*y), with y initialized to nlm_prev
+            np.copyto(nlm[nt,:], nlm_prev)
+            zgemv(dt, M, nlm_prev, beta=1, y=nlm[nt,:], overwrite_y=True)
+            
+    for nt in np.arange(1,Nt+1):
+        step(nt)
+        _bar_update(bar, nt, Nt)
+    
+    
+def _integrate_rk4(sf, nlm, M_static, Gamma0, S, dt, bar=None):
 
-    if verbose: bar = Bar('MOD=%s :: Nt=%i :: dt=%.2e :: nlm_len=%i ::'%(mod['type'],Nt,dt,nlm_len), max=Nt-1, fill='#', suffix='%(percent).1f%% - %(eta)ds')
+    """
+    Exponential (time-constant operator) or fourth-order Runge--Kutta (DDRX) integration of nlm[0,:] (in-place)
+    """
     
+    Nt = nlm.shape[0]-1
+    
+    if Gamma0 is None and Nt < EXPM_MULTIPLY_MAXSTEPS_PER_NLM2*M_static.shape[0]**2:
+        # Time-constant operator, few steps: expm(t*M).nlm(0) at all times t using only sparse matvecs (no dense O(nlm_len^3) expm)
+        nlm[1:,:] = expm_multiply(csr_matrix(M_static), nlm[0,:], start=0, stop=Nt*dt, num=Nt+1, endpoint=True)[1:,:]
+        _bar_update(bar, Nt, Nt)
+        return
+        
+    if Gamma0 is None:
+        # Time-constant operator: nlm(t+dt) = expm(dt*M).nlm(t) 
+        P = np.asfortranarray(expm(dt*M_static))
+        for nt in np.arange(1,Nt+1):
+            zgemv(1, P, nlm[nt-1,:], beta=0, y=nlm[nt,:], overwrite_y=True)
+            _bar_update(bar, nt, Nt)
+        return
+        
+    dndt = lambda nlm_: np.matmul(M_static + Gamma0*sf.M_DDRX(nlm_, S), nlm_)
     for nt in np.arange(1,Nt+1):
         nlm_prev = nlm[nt-1,:]
-        M = M_LROT + M_CDRX + M_REG
-        M += Gamma0_*sf.M_DDRX(nlm_prev, S) if Gamma0_ is not None else M_zero
-        nlm[nt,:] = nlm_prev + dt*np.matmul(M, nlm_prev)
+        k1 = dndt(nlm_prev)
+        k2 = dndt(nlm_prev + dt/2*k1)
+        k3 = dndt(nlm_prev + dt/2*k2)
+        k4 = dndt(nlm_prev + dt*k3)
+        nlm[nt,:] = nlm_prev + dt/6*(k1 + 2*k2 + 2*k3 + k4)
+        _bar_update(bar, nt, Nt)
+        
+        
+def _integrate_parareal(sf, nlm, M_static, Gamma0, S, dt, nprocs=None, tol=1e-6, maxiter=None, bar=None):
+
+    """
+    Parareal integration of nlm[0,:] (in-place) with explicit Euler as the fine propagator.
+    
+    The time span is split into K subintervals (one per process), each spanned by a single exponential Euler step for the coarse propagator.
+    The iteration U_{n+1} <- G(U_n) + F(U_n) - G_prev(U_n) is exact after K iterations, but typically converges (to tol, relative) much sooner.
+    """
+
+    Nt = nlm.shape[0]-1
+    K = min(nprocs if nprocs is not None else (os.cpu_count() or 1), Nt)
+    if K < 2: 
+        return _integrate_euler(sf, nlm, M_static, Gamma0, S, dt, bar=bar) # nothing to parallelize
+        
+    nt_ = np.linspace(0, Nt, K+1).astype(int) # subinterval boundaries (time step index) 
+    abstol = tol*np.amax(np.abs(nlm[0,:]))
+    
+    def G(U, n):
+        M = M_static if Gamma0 is None else M_static + Gamma0*sf.M_DDRX(U, S)
+        return np.matmul(expm((nt_[n+1]-nt_[n])*dt*M), U)
         
-        if verbose: bar.next()
-    bar.finish()
+    U = np.zeros((K+1,nlm.shape[1]), dtype=np.complex128) # solution at subinterval boundaries
+    U[0,:] = nlm[0,:]
+    G_prev = np.zeros((K,nlm.shape[1]), dtype=np.complex128) 
+    for n in range(K):
+        G_prev[n,:] = G(U[n,:], n)
+        U[n+1,:] = G_prev[n,:]
+        
+    # Fork workers where supported: other start methods re-import the calling script in each worker, which breaks unguarded scripts
+    mp_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    
+    try:
+        with ProcessPoolExecutor(max_workers=K, mp_context=mp_context, initializer=_parareal_init, initargs=(sf.Lcap,)) as executor:
+            for kk in range(K if maxiter is None else maxiter):
+                fine = list(executor.map(_parareal_fine, U[:-1,:], [nt_[n+1]-nt_[n] for n in range(K)], *[[arg]*K for arg in (M_static, Gamma0, S, dt)]))
+                for n in range(K): 
+                    nlm[nt_[n]+1:nt_[n+1]+1,:] = fine[n]
+                U_prev = U.copy()
+                for n in range(K):
+                    G_n = G(U[n,:], n)
+                    U[n+1,:] = G_n + fine[n][-1,:] - G_prev[n,:]
+                    G_prev[n,:] = G_n
+                if np.amax(np.abs(U - U_prev)) < abstol: 
+                    break
+                if bar is not None: bar.goto(nt_[kk+1]) # the first kk+1 subintervals are exact after iteration kk
+    except (BrokenProcessPool, OSError) as e:
+        warnings.warn('lagrangianparcel(): parareal worker processes could not be started (%s), falling back to serial integration'%(e))
+        return _integrate_euler(sf, nlm, M_static, Gamma0, S, dt, bar=bar)
+        
+    if bar is not None: bar.goto(Nt)
+    
+    
+def _parareal_init(L):
+    sf__.init(L) # worker processes must initialize their own copy of the fortran module
+    
+    
+def _parareal_fine(nlm0, Nt, M_static, Gamma0, S, dt):
+
+    """
+    Fine (explicit Euler) parareal propagator over Nt time steps, run by worker processes
+    """
+    
+    nlm = np.zeros((Nt+1,len(nlm0)), dtype=np.complex128, order='C')
+    nlm[0,:] = nlm0
+    _integrate_euler(sf__, nlm, M_static, Gamma0, S, dt)
+    return nlm[1:,:]
+    
+    
+def _euler(nlm, M, dt, nt0, nt1):
+
+    """
+    Euler steps nlm[nt] = nlm[nt-1] + dt*M.nlm[nt-1] for nt0 <= nt < nt1 (in-place)
+    """
+    
+    # Explicit loops rather than np.matmul: for the small matrices considered, numba-compiled loops avoid the numpy dispatch overhead.
+    # Column-oriented (saxpy) loop order, so that the column-major M (as returned by specfab) is traversed contiguously.
+    nlm_len = nlm.shape[1]
+    for nt in range(nt0, nt1):
+        for ii in range(nlm_len):
+            nlm[nt,ii] = nlm[nt-1,ii]
+        for jj in range(nlm_len):
+            dtnlm_jj = dt*nlm[nt-1,jj]
+            for ii in range(nlm_len):
+                nlm[nt,ii] += M[ii,jj]*dtnlm_jj
             
-    return nlm, F, time, ugrad
-                
+def _euler_csr(nlm, data, indices, indptr, dt, nt0, nt1):
+
+    """
+    Same as _euler() but for M in CSR form (data, indices, indptr)
+    """
+    
+    nlm_len = nlm.shape[1]
+    for nt in range(nt0, nt1):
+        for ii in range(nlm_len):
+            dndt = 0j
+            for kk in range(indptr[ii], indptr[ii+1]):
+                dndt += data[kk]*nlm[nt-1,indices[kk]]
+            nlm[nt,ii] = nlm[nt-1,ii] + dt*dndt
+            
+if njit is not None: 
+    _euler     = njit(cache=True, fastmath=True)(_euler)
+    _euler_csr = njit(cache=True, fastmath=True)(_euler_csr)
+    
     
 def M_REG_custom(nu, expo, D, sf):
 
@@ -90,10 +385,10 @@ def M_REG_custom(nu, expo, D, sf):
 
     L = sf.Lcap
     nlm_len = int((L+1)*(L+2)/2)
-    nlm_dummy = np.zeros((nlm_len), dtype=np.complex64)
-    L = sf.Lmat(nlm_dummy)/(L*(L+1)) # normalized laplacian matrix
+    nlm_dummy = np.zeros((nlm_len), dtype=np.complex128)
+    Ldiag = np.diag(sf.Lmat(nlm_dummy))/(L*(L+1)) # normalized laplacian matrix is diagonal
     ratemag = nu*np.linalg.norm(D)
-    M_REG = -ratemag*np.power(np.abs(L), expo)
+    M_REG = np.diag(-ratemag*np.power(np.abs(Ldiag), expo)) # off-diagonal entries are zero for expo > 0, so evaluate the power of the diagonal only
     
     return M_REG
 
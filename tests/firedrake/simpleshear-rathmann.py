@@ -57,6 +57,54 @@ fabric.set_isotropic_BCs((1,))
 
 tau = fd.project(fd.grad(u), T) # assume coaxial driving stress
 
+# Sampling points and triangulation for plotting fields, built once for the (fixed) mesh and reused for all frames
+plotter = fd.pyplot.FunctionPlotter(mesh, num_sample_points=10)
+
+"""
+Setup figure (once, only time-dependent artists are redrawn per frame)
+"""
+
+figscale = 1
+fig = plt.figure(figsize=(14*figscale, 8*figscale))
+gs = gridspec.GridSpec(1, 3, wspace=0.25, hspace=0.3, left=0.08, right=0.97, top=0.98, bottom=0.37)
+ax1 = fig.add_subplot(gs[0,0])
+ax2 = fig.add_subplot(gs[0,1])
+ax3 = fig.add_subplot(gs[0,2])
+axes = (ax1,ax2,ax3)
+
+kwargs_cb = dict(pad=0.12, aspect=22, fraction=0.09, orientation='horizontal')
+
+# velocity field is time constant
+h = fd.pyplot.quiver(u, axes=ax1, cmap='Reds', width=0.0075)
+cbar = plt.colorbar(h, ax=ax1, **kwargs_cb)
+cbar.ax.set_xlabel(r'$\bf u$')
+
+kwargs_J = dict(levels=np.arange(1, 2 +1e-3, 0.1), extend='both', cmap='YlGnBu')
+
+E0, E1, dE = (0.5, 1.5, 0.1)
+lvls = np.arange(E0, E1+1e-3, dE)
+divnorm = colors.TwoSlopeNorm(vmin=np.amin(lvls), vcenter=1, vmax=np.amax(lvls))
+kwargs_E = dict(levels=lvls, norm=divnorm, extend='both', cmap='PuOr_r')
+
+# plot grids 
+for ax in axes:
+    ax.set_xlabel('$x$')
+    ax.set_ylabel('$z$')
+    ax.set_xlim([0,1])
+    ax.set_ylim([0,1])
+    fd.pyplot.triplot(mesh, axes=ax, interior_kw=dict(lw=0.1), boundary_kw=dict(lw=5, clip_on=False))
+
+# ODF insets (xins,yins) for selected locations (CPOx,CPOy)
+ODF_insets = ((0.2,0.08, 0.1,0.1, '^'), (0.4,0.08, 0.5,0.4, 'X'), (0.6,0.08, 0.9,0.6, 's'))
+geo, prj = sfplt.getprojection(rotation=-90-20, inclination=50)
+W = 0.18
+axins = [plt.axes([xins,yins, W,W], projection=prj) for (xins,yins, _,_, _) in ODF_insets]
+for (_,_, CPOx,CPOy, mrk) in ODF_insets:
+    for ax in (ax1,ax2):
+        ax.plot(CPOx, CPOy, mrk, markersize=12, markeredgewidth=1.1, markeredgecolor='k', markerfacecolor='w')
+
+h_J = h_E = None # contour sets of previous frame
+
 """
 Time evolution
 """
@@ -88,72 +136,40 @@ while nn < Nt:
         fname = 'simpleshear-%s-%02d.png'%('LROT' if Gamma0 is None else 'DDRX', nn)
         print('[->] Plotting model state: %s'%(fname))
 
-        ### Setup figure
+        ### Update time-dependent artists
         
-        figscale = 1
-        fig = plt.figure(figsize=(14*figscale, 8*figscale))
-        gs = gridspec.GridSpec(1, 3, wspace=0.25, hspace=0.3, left=0.08, right=0.97, top=0.98, bottom=0.37)
-        ax1 = fig.add_subplot(gs[0,0])
-        ax2 = fig.add_subplot(gs[0,1])
-        ax3 = fig.add_subplot(gs[0,2])
-        axes = (ax1,ax2,ax3)
-        
-        kwargs_cb = dict(pad=0.12, aspect=22, fraction=0.09, orientation='horizontal')
+        firstframe = h_J is None
+        if not firstframe:
+            h_J.remove()
+            h_E.remove()
 
-        ax = ax1
-        h = fd.pyplot.quiver(u, axes=ax, cmap='Reds', width=0.0075)
-        cbar = plt.colorbar(h, ax=ax, **kwargs_cb)
-        cbar.ax.set_xlabel(r'$\bf u$')
-        
-        ax = ax2
         J = fd.project(fd.dot(fabric.w,fabric.w)/np.linalg.norm(fabric.nlm_iso)**2, Q)
-        h = fd.pyplot.tricontourf(J, axes=ax, levels=np.arange(1, 2 +1e-3, 0.1), extend='both', cmap='YlGnBu')
-        cbar = plt.colorbar(h, ax=ax, **kwargs_cb)
-        cbar.ax.set_xlabel(r'$J$ (CPO strength)')
-
-        ax = ax3
-        E0, E1, dE = (0.5, 1.5, 0.1)
-        lvls = np.arange(E0, E1+1e-3, dE)
-        divnorm = colors.TwoSlopeNorm(vmin=np.amin(lvls), vcenter=1, vmax=np.amax(lvls))
-        kwargs_E = dict(levels=lvls, norm=divnorm, extend='both', cmap='PuOr_r')
+        h_J = ax2.tricontourf(plotter.triangulation, plotter(J), **kwargs_J)
+
         E_CAFFE = fabric.E_CAFFE(u)
-        h = fd.pyplot.tricontourf(E_CAFFE, axes=ax, **kwargs_E)
-        cbar = plt.colorbar(h, ax=ax, **kwargs_cb)
-        cbar.ax.set_xlabel(r'$E$ (CAFFE)')
+        h_E = ax3.tricontourf(plotter.triangulation, plotter(E_CAFFE), **kwargs_E)
         
-        # plot grids 
-        for ax in axes:
-            ax.set_xlabel('$x$')
-            ax.set_ylabel('$z$')
-            ax.set_xlim([0,1])
-            ax.set_ylim([0,1])
-            fd.pyplot.triplot(mesh, axes=ax, interior_kw=dict(lw=0.1), boundary_kw=dict(lw=5, clip_on=False))
+        if firstframe: # levels are fixed, so colorbars need only be drawn once
+            cbar = plt.colorbar(h_J, ax=ax2, **kwargs_cb)
+            cbar.ax.set_xlabel(r'$J$ (CPO strength)')
+            cbar = plt.colorbar(h_E, ax=ax3, **kwargs_cb)
+            cbar.ax.set_xlabel(r'$E$ (CAFFE)')
 
         ### ODF insets
         
-        def plot_ODF(x,y, CPOx,CPOy, mrk, W=0.18):
-
-            geo, prj = sfplt.getprojection(rotation=-90-20, inclination=50)   
-            axin = plt.axes([x,y , W, W], projection=prj) 
+        for axin, (_,_, CPOx,CPOy, mrk) in zip(axins, ODF_insets):
+            axin.clear()
             axin.set_global()
-            for ax in (ax1,ax2):
-                points, = ax.plot(CPOx, CPOy, mrk, markersize=12, markeredgewidth=1.1, markeredgecolor='k', markerfacecolor='w')
-            sfplt.plotODF(fabric.get_nlm(CPOx, CPOy), fabric.lm, axin, cmap='Greys', cblabel='ODF', lvlset=(np.linspace(0.1, 0.3, 5), lambda x,p:'%.1f'%x), showcb=True)
+            sfplt.plotODF(fabric.get_nlm(CPOx, CPOy), fabric.lm, axin, cmap='Greys', cblabel='ODF', lvlset=(np.linspace(0.1, 0.3, 5), lambda x,p:'%.1f'%x), showcb=firstframe)
             sfplt.plotcoordaxes(axin, geo, color='k')
             kwargs = dict(marker='.', ms=7, markeredgewidth=1.0, transform=geo, zorder=10, markerfacecolor=sfplt.c_dred, markeredgecolor=sfplt.c_dred)
             m1 = fabric.eigenframe(CPOx, CPOy)[0][:,0] # pick out m1
             sfplt.plotS2point(axin, +m1, **kwargs)
             sfplt.plotS2point(axin, -m1, **kwargs)
             axin.set_title(r'@ "%s"'%(mrk))
-
-        # Plot for selected locations
-        plot_ODF(0.2,0.08, 0.1,0.1, '^')
-        plot_ODF(0.4,0.08, 0.5,0.4, 'X')
-        plot_ODF(0.6,0.08, 0.9,0.6, 's')
             
         ### Save plot
         
-        plt.savefig(fname, dpi=100)
-        plt.close()
+        fig.savefig(fname, dpi=100) # figure is reused for next frame
         print('[OK] Done')
         
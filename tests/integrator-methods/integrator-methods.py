@@ -0,0 +1,71 @@
+# N. M. Rathmann <rathmann@nbi.ku.dk>, 2024
+
+"""
+Tests the time integration schemes of the Lagrangian parcel integrator (sfint.lagrangianparcel) against each other:
+    method='rk4'      at small Nt should agree with method='euler' at large Nt (converged)
+    method='rk4'      without DDRX is exact (matrix exponential), so should not depend on Nt
+    method='parareal' should reproduce method='euler' to within the parareal tolerance (same Nt)
+for pure shear with and without DDRX
+"""
+
+import sys, os, copy, code # code.interact(local=locals())
+import numpy as np
+
+from specfabpy import specfab as sf
+from specfabpy import integrator as sfint
+
+#----------------------
+# Setup
+#----------------------
+
+L = 8
+lm, nlm_len = sf.init(L)
+
+mod = dict(type='ps', axis=2, r=0, T=1) # uniaxial compression
+strain_target = -0.8
+
+Nt_euler = 20000 # many steps for converged euler solution
+Nt_rk4   = 20    # few steps
+Nt_exp   = (3, 2000) # few and many steps of the exact propagator 
+Nt_pr    = 1000  # parareal vs euler for the same number of steps
+nprocs   = 4     # number of parareal processes (subintervals)
+
+tol_rk4 = 1e-4 # relative; euler at Nt_euler is only first-order accurate
+tol_exp = 1e-10 # relative; round-off only
+tol_pr  = 1e-5 # relative; parareal iterates until subinterval boundaries change less than 1e-6 (relative)
+
+cases = {
+    'LROT+REG'      : dict(iota=1, nu=1),
+    'LROT+REG+DDRX' : dict(iota=1, nu=1, Gamma0=3),
+}
+
+#----------------------
+# Integrate and compare
+#----------------------
+
+relerr = lambda nlm, nlm_ref: np.amax(np.abs(nlm-nlm_ref))/np.amax(np.abs(nlm_ref))
+
+passed = True
+
+for name, kwargs in cases.items():
+
+    nlm_euler = sfint.lagrangianparcel(sf, copy.copy(mod), strain_target, Nt=Nt_euler, method='euler', verbose=False, **kwargs)[0]
+    nlm_rk4   = sfint.lagrangianparcel(sf, copy.copy(mod), strain_target, Nt=Nt_rk4,   method='rk4',   verbose=False, **kwargs)[0]
+    err_rk4 = relerr(nlm_rk4[-1,:], nlm_euler[-1,:])
+    
+    if 'Gamma0' not in kwargs:
+        nlm_rk4_few, nlm_rk4_many = [sfint.lagrangianparcel(sf, copy.copy(mod), strain_target, Nt=Nt, method='rk4', verbose=False, **kwargs)[0] for Nt in Nt_exp]
+        err_exp = relerr(nlm_rk4_few[-1,:], nlm_rk4_many[-1,:])
+    
+    nlm_euler = sfint.lagrangianparcel(sf, copy.copy(mod), strain_target, Nt=Nt_pr, method='euler',    verbose=False, **kwargs)[0]
+    nlm_pr    = sfint.lagrangianparcel(sf, copy.copy(mod), strain_target, Nt=Nt_pr, method='parareal', verbose=False, nprocs=nprocs, **kwargs)[0]
+    err_pr = relerr(nlm_pr, nlm_euler)
+    
+    checks = [('rk4', err_rk4, tol_rk4), ('parareal', err_pr, tol_pr)]
+    if 'Gamma0' not in kwargs: checks.insert(1, ('rk4 (exp)', err_exp, tol_exp))
+    for method, err, tol in checks:
+        ok = err < tol
+        passed = passed and ok
+        print('%-14s %-10s rel. err. = %.2e (tol = %.0e) ... %s'%(name, method, err, tol, 'OK' if ok else 'FAILED'))
+
+sys.exit(0 if passed else 1)